@@ -1 +1 @@
-from .algorithm import flatten_detector
+from .algorithm import flatten_detector, interpolation_cfunc
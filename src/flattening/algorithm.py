@@ -1,34 +1,40 @@
 import ctypes
+import functools
+import logging
 import numpy as np
 from pathlib import Path
+from typing import Optional, Tuple
 
+try:
+    import numba
+except ImportError:
+    numba = None
 
-def _load_library() -> ctypes.CDLL:
-    """Load the shared C library.
+try:
+    import cupy
+except ImportError:
+    cupy = None
 
-    Returns:
-        ctypes.CDLL: The shared library.
-    """
-    lib_path = next(Path(__file__).parent.glob("interpolate*.so"))
-    return ctypes.CDLL(lib_path)
+logger = logging.getLogger(__name__)
 
 
-def _interpolate(projections: np.ndarray, normalized_angles: np.ndarray, batch_size: int = 100) -> np.ndarray:
-    """Performs the linear interpolation necessary to map the pixel values
-    on the virtual flat detector.
-    Args:
-        projections (np.ndarray[ndim=3]): A set of 2D projections.
-        normalized_angles (np.ndarray[ndim=1]): The angles corresponding to the
-            columns of the curved detector.
-        batch_size (int): Number of projections to process at once. Defaults to 100.
+def _load_library() -> Optional[ctypes.CDLL]:
+    """Load the shared C library and configure the signature of its functions.
+
     Returns:
-        np.ndarray[ndim=3]: The set of flattened projections.
+        Optional[ctypes.CDLL]: The shared library, or None if it was not built.
     """
-    lib = _load_library()
+    lib_path = next(Path(__file__).parent.glob("interpolate*.so"), None)
+    if lib_path is None:
+        return None
+    lib = ctypes.CDLL(lib_path)
+    logger.debug("loaded %s", lib_path)
+
     # Define C function signature
     lib.interpolation_loop.argtypes = [
         ctypes.POINTER(ctypes.c_float),  # proj
-        ctypes.POINTER(ctypes.c_double),  # normalized_angles
+        ctypes.POINTER(ctypes.c_int32),  # idx
+        ctypes.POINTER(ctypes.c_float),  # frac
         ctypes.POINTER(ctypes.c_float),  # out
         ctypes.c_int,  # num_angles
         ctypes.c_int,  # num_rows
@@ -36,57 +42,365 @@ def _interpolate(projections: np.ndarray, normalized_angles: np.ndarray, batch_s
         ctypes.c_int,  # num_cols
     ]
     lib.interpolation_loop.restype = None  # void function
-    
+
+    lib.interpolation_loop_u16.argtypes = [
+        ctypes.POINTER(ctypes.c_uint16),  # proj
+        *lib.interpolation_loop.argtypes[1:],
+    ]
+    lib.interpolation_loop_u16.restype = None  # void function
+
+    lib.warmup.argtypes = [ctypes.c_int]  # num_threads
+    lib.warmup.restype = None  # void function
+
+    return lib
+
+
+# Loaded once at import, so that repeated calls do not pay for it
+_LIB = _load_library()
+
+
+@functools.lru_cache(maxsize=None)
+def _warmup_library() -> None:
+    """Start the OpenMP threads of the C library, the first time it is used
+    only, so that later calls find them already running."""
+    _LIB.warmup(0)
+
+
+# Tiling of the interpolation loop, as in the C library
+_BLOCK_ROWS = 16
+_BLOCK_COLS = 1024
+
+# Maximum size of the converted copy of the projections held at once (in bytes)
+_BATCH_BYTES = 512 * 1024**2
+
+
+if numba is not None:
+
+    @numba.njit(cache=True, parallel=True, fastmath=True, nogil=True)
+    def _interp_numba(proj, idx, frac, out, num_threads):
+        """Numba version of the C interpolation loop. (See `_interpolate`.)"""
+        num_proj, num_rows, num_cols = out.shape
+        # (p,r) rows are contiguous in both proj & out, so they are tiled as one axis
+        proj_rows = proj.reshape(num_proj * num_rows, proj.shape[2])
+        out_rows = out.reshape(num_proj * num_rows, num_cols)
+        total_rows = num_proj * num_rows
+
+        # Smaller blocks for small stacks, so that no thread is left without work
+        block_rows = max(1, min(_BLOCK_ROWS, (total_rows + num_threads - 1) // num_threads))
+        num_blocks = (total_rows + block_rows - 1) // block_rows
+
+        for b in numba.prange(num_blocks):
+            n_start = b * block_rows
+            n_end = min(n_start + block_rows, total_rows)
+            for c_start in range(0, num_cols, _BLOCK_COLS):
+                c_end = min(c_start + _BLOCK_COLS, num_cols)
+                for n in range(n_start, n_end):
+                    for c in range(c_start, c_end):
+                        v0 = proj_rows[n, idx[c]]  # value at left neighbor
+                        v1 = proj_rows[n, idx[c] + 1]  # value at right neighbor
+                        out_rows[n, c] = v0 + (v1 - v0) * frac[c]
+
+
+def _empty_aligned(shape: Tuple[int, ...], dtype, alignment: int = 64) -> np.ndarray:
+    """Allocate an uninitialized C-contiguous array whose base pointer is on an
+    `alignment`-byte boundary (NumPy only guarantees 16 bytes). Only the start
+    of the array is aligned, e.g. not the rows of a 2D array in general.
+
+    The array is a view of a larger uint8 buffer, so it is only used for the
+    internal indices and weights, never for arrays returned to the caller.
+
+    Args:
+        shape (Tuple[int, ...]): The shape of the array.
+        dtype (np.dtype): The type of the array.
+        alignment (int, optional): The alignment in bytes. Defaults to 64.
+
+    Returns:
+        np.ndarray: The aligned array.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buffer = np.empty(nbytes + alignment, dtype=np.uint8)
+    offset = -buffer.ctypes.data % alignment
+    return buffer[offset : offset + nbytes].view(dtype).reshape(shape)
+
+
+def _interpolation_weights(
+    normalized_angles: np.ndarray, orig_num_detectors: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute, for every column of the flat detector, the index of its left
+    neighbour on the curved detector and the weight of its right neighbour.
+
+    Columns falling outside of the curved detector are clamped to its first
+    or last pixel, so that no bounds check is needed when interpolating.
+    A curved detector with a single column has no right neighbour: all the
+    indices and weights are 0, and `_interpolate` copies that column instead.
+
+    Args:
+        normalized_angles (np.ndarray[ndim=1]): The angles corresponding to the
+            columns of the curved detector.
+        orig_num_detectors (int): The number of columns of the curved detector.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The indices (int32) and the weights (float32).
+    """
+    if orig_num_detectors == 1:
+        idx = np.zeros_like(normalized_angles)
+        frac = np.zeros_like(normalized_angles)
+    else:
+        idx = np.floor(normalized_angles)
+        frac = normalized_angles - idx
+
+        # before first detector
+        before = idx < 0
+        idx[before] = 0
+        frac[before] = 0
+        # after last detector
+        after = idx >= orig_num_detectors - 1
+        idx[after] = orig_num_detectors - 2
+        frac[after] = 1
+
+    idx_a = _empty_aligned(idx.shape, np.int32)
+    idx_a[...] = idx
+    frac_a = _empty_aligned(frac.shape, np.float32)
+    frac_a[...] = frac
+
+    return idx_a, frac_a
+
+
+@functools.lru_cache(maxsize=None)
+def interpolation_cfunc():
+    """Compile the Numba interpolation kernel as a C-callable function.
+
+    This allows code outside of Python (e.g. a C/C++ reconstruction framework)
+    to call the kernel through a plain function pointer, `.address`, with the
+    same signature as `interpolation_loop` in the C library:
+
+        void (const float *proj, const int32_t *idx, const float *frac, float *out,
+              int32_t num_proj, int32_t num_rows, int32_t orig_num_detectors,
+              int32_t num_cols)
+
+    The indices and weights are those computed for `flatten_detector`, and
+    the curved detector must have at least two columns. The function is
+    compiled on the first call only.
+
+    Returns:
+        numba.core.ccallback.CFunc: The compiled function.
+    """
+    if numba is None:
+        raise RuntimeError("Compiling the C-callable kernel requires Numba to be installed.")
+
+    sig = numba.void(
+        numba.types.CPointer(numba.float32),  # proj
+        numba.types.CPointer(numba.int32),  # idx
+        numba.types.CPointer(numba.float32),  # frac
+        numba.types.CPointer(numba.float32),  # out
+        numba.int32,  # num_proj
+        numba.int32,  # num_rows
+        numba.int32,  # orig_num_detectors
+        numba.int32,  # num_cols
+    )
+
+    @numba.cfunc(sig)
+    def _interp_cfunc(proj, idx, frac, out, num_proj, num_rows, orig_num_detectors, num_cols):
+        _interp_numba(
+            numba.carray(proj, (num_proj, num_rows, orig_num_detectors)),
+            numba.carray(idx, (num_cols,)),
+            numba.carray(frac, (num_cols,)),
+            numba.carray(out, (num_proj, num_rows, num_cols)),
+            numba.get_num_threads(),
+        )
+
+    return _interp_cfunc
+
+
+def _interp_numpy(
+    proj: np.ndarray, idx: np.ndarray, frac: np.ndarray, out: np.ndarray
+) -> None:
+    """NumPy version of the C interpolation loop. (See `_interpolate`.)
+
+    Through NumPy's dispatch protocols, this also runs on CuPy arrays.
+    """
+    # out = left + (right - left) * frac, with a single temporary
+    np.take(proj, idx, axis=2, out=out)
+    right = proj.take(idx + 1, axis=2)
+    np.subtract(right, out, out=right)
+    np.multiply(right, frac, out=right)
+    np.add(out, right, out=out)
+
+
+def _select_backend(backend: str) -> str:
+    """Resolve the backend used for the interpolation.
+
+    Args:
+        backend (str): One of "auto", "numba", "c", "numpy" or "cuda".
+
+    Returns:
+        str: The backend to use ("numba", "c", "numpy" or "cuda").
+    """
+    if backend == "auto":
+        if _LIB is not None:
+            backend = "c"
+        elif numba is not None:
+            backend = "numba"
+        else:
+            backend = "numpy"
+
+    if backend == "numba" and numba is None:
+        raise RuntimeError("The 'numba' backend requires Numba to be installed.")
+    if backend == "c" and _LIB is None:
+        raise RuntimeError("The 'c' backend requires the compiled C library.")
+    if backend == "c":
+        _warmup_library()
+    if backend == "cuda" and cupy is None:
+        raise RuntimeError("The 'cuda' backend requires CuPy to be installed.")
+    if backend not in ("numba", "c", "numpy", "cuda"):
+        raise ValueError(f"Unknown backend '{backend}'.")
+
+    return backend
+
+
+def _interpolate(
+    projections: np.ndarray,
+    idx: np.ndarray,
+    frac: np.ndarray,
+    backend: str = "auto",
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Performs the linear interpolation necessary to map the pixel values
+    on the virtual flat detector.
+
+    For each projection and row, this is equivalent to
+    `np.interp(normalized_angles, np.arange(orig_num_detectors), row)`. Since
+    the curved detector is a uniform grid, the kernels use the neighbours and
+    weights found once by `_interpolation_weights` instead of searching for
+    them in every row.
+
+    With the "c" backend, 16-bit unsigned projections (the raw detector
+    counts) are interpolated as they are, which saves converting them to
+    float32 first. Otherwise, the projections are converted to float32.
+    The output is always float32.
+
+    Args:
+        projections (np.ndarray[ndim=3]): A set of 2D projections.
+        idx (np.ndarray[ndim=1]): The index of the left neighbour of each column
+            of the flat detector.
+        frac (np.ndarray[ndim=1]): The weight of the right neighbour of each column
+            of the flat detector.
+        backend (str): The implementation of the interpolation loop, one of "c",
+            "numba", "numpy" or "auto" (the first one available in this order), or
+            "cuda" (on the GPU, through CuPy). Defaults to "auto".
+        out (Optional[np.ndarray[ndim=3]]): The array in which to store the result.
+            It must be a C-contiguous float32 array of the right shape (a CuPy
+            array for the "cuda" backend), which does not overlap `projections`.
+            Defaults to None, i.e. a new array is allocated.
+    Returns:
+        np.ndarray[ndim=3]: The set of flattened projections (a CuPy array for
+            the "cuda" backend).
+    """
+    backend = _select_backend(backend)
+    # Array module of the output
+    xp = cupy if backend == "cuda" else np
+
     num_proj, num_rows, orig_num_detectors = projections.shape
-    num_cols = len(normalized_angles)
-    
-    out = np.zeros((num_proj, num_rows, num_cols), dtype=np.float32)
-    ang_c = np.ascontiguousarray(normalized_angles, dtype=np.float64)
+    num_cols = len(idx)
     
+    out_shape = (num_proj, num_rows, num_cols)
+    if out is None:
+        # Every cell is written by the kernel, so there is no need to zero it
+        out = xp.empty(out_shape, dtype=np.float32)
+    elif not isinstance(out, xp.ndarray):
+        raise ValueError(f"'out' must be a {xp.__name__} array.")
+    elif out.shape != out_shape or out.dtype != np.float32:
+        raise ValueError(f"'out' must be a float32 array of shape {out_shape}.")
+    elif not out.flags.c_contiguous or (xp is np and not out.flags.writeable):
+        raise ValueError("'out' must be a writeable C-contiguous array.")
+    elif isinstance(projections, xp.ndarray) and xp.may_share_memory(out, projections):
+        # The kernels read the projections after writing to out
+        raise ValueError("'out' must not overlap the projections.")
+    if projections.dtype == np.uint16 and backend == "c":
+        proj_dtype = np.uint16
+    else:
+        proj_dtype = np.float32
+    if (
+        isinstance(projections, xp.ndarray)
+        and projections.dtype == proj_dtype
+        and projections.flags.c_contiguous
+    ):
+        # Already usable by the kernel: a single call, which parallelizes internally
+        batch_size = max(num_proj, 1)
+    else:
+        # Converted in batches, to bound the memory taken by the copy
+        proj_bytes = num_rows * orig_num_detectors * np.dtype(proj_dtype).itemsize
+        batch_size = max(_BATCH_BYTES // max(proj_bytes, 1), 1)
+    if orig_num_detectors == 1:
+        # No right neighbour to interpolate with: every column takes its value
+        out[...] = xp.asarray(projections)
+        return out
+
+    # On the GPU, the indices and weights are uploaded once per call
+    idx_c = xp.ascontiguousarray(xp.asarray(idx), dtype=np.int32)
+    frac_c = xp.ascontiguousarray(xp.asarray(frac), dtype=np.float32)
+
     # Process in batches
     for start_idx in range(0, num_proj, batch_size):
         end_idx = min(start_idx + batch_size, num_proj)
         
-        # Convert batch to C-ordered arrays
-        proj_c = np.ascontiguousarray(projections[start_idx:end_idx], dtype=np.float32)
-        out_c = np.ascontiguousarray(out[start_idx:end_idx], dtype=np.float32)
-        
-        # Run C function on batch
-        lib.interpolation_loop(
-            proj_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-            ang_c.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-            out_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-            ctypes.c_int(end_idx - start_idx),
-            ctypes.c_int(num_rows),
-            ctypes.c_int(orig_num_detectors),
-            ctypes.c_int(num_cols),
-        )
+        # Convert batch to C-ordered arrays, which does not copy projections
+        # that already are C-contiguous and of the kernel type
+        proj_c = xp.ascontiguousarray(xp.asarray(projections[start_idx:end_idx]), dtype=proj_dtype)
+        # Slicing along the first axis keeps the output C-contiguous
+        out_c = out[start_idx:end_idx]
         
-        # Copy results back to output array
-        out[start_idx:end_idx] = out_c
-    
+        if backend == "numba":
+            _interp_numba(proj_c, idx_c, frac_c, out_c, numba.get_num_threads())
+        elif backend in ("numpy", "cuda"):
+            _interp_numpy(proj_c, idx_c, frac_c, out_c)
+        elif proj_dtype == np.uint16:
+            _LIB.interpolation_loop_u16(
+                proj_c.ctypes.data_as(ctypes.POINTER(ctypes.c_uint16)),
+                idx_c.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+                frac_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                out_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                ctypes.c_int(end_idx - start_idx),
+                ctypes.c_int(num_rows),
+                ctypes.c_int(orig_num_detectors),
+                ctypes.c_int(num_cols),
+            )
+        else:
+            # Run C function on batch
+            _LIB.interpolation_loop(
+                proj_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                idx_c.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+                frac_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                out_c.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                ctypes.c_int(end_idx - start_idx),
+                ctypes.c_int(num_rows),
+                ctypes.c_int(orig_num_detectors),
+                ctypes.c_int(num_cols),
+            )
+
     return out
 
 
-def flatten_detector(
-    proj: np.ndarray,
-    DSD: float,
-    arclength: float,
-    oversample: int = 1,
-) -> np.ndarray:
-    """Flatten the projections.
+@functools.lru_cache(maxsize=32)
+def _flat_geometry(
+    DSD: float, arclength: float, oversample: int, orig_num_detectors: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute the interpolation indices and weights of the flat detector.
+
+    These only depend on the geometry, not on the projections, so they are
+    cached and reused by successive calls on the same scanner.
 
     Args:
-        proj (np.ndarray[ndim=3]): The set of 2D curved projections.
         DSD (float): The distance from detector to source (in mm).
         arclength (float): The angular span of the detector (in rad).
-        oversample (int, optional): The amount of oversampling on the flat plane.
-            Defaults to 1.
+        oversample (int): The amount of oversampling on the flat plane.
+        orig_num_detectors (int): The number of columns of the curved detector.
 
     Returns:
-        np.ndarray[ndim=3]: The set of flattened projections.
+        Tuple[np.ndarray, np.ndarray]: The indices (int32) and the weights (float32),
+            both read-only.
     """
-    orig_num_detectors = proj.shape[-1]
     pixel_arclength = arclength / orig_num_detectors
 
     # Calculate the size of the detector projected from the arc onto the plane
@@ -100,23 +414,80 @@ def flatten_detector(
     detector_size = detector_size / oversample
     total_detector_size = np.tan(arclength / 2) * DSD * 2
 
-    # Calculate the equal distance detector positions on the plane detector
+    # Calculate the equal distance detector positions on the plane detector,
+    # as integer multiples of the detector size
     if orig_num_detectors % 2:
         # Odd number of detectors - one on the centreline
-        detectors = np.arange(detector_size, total_detector_size / 2, detector_size)
-        detectors = np.concatenate((np.flip(-detectors), [0], detectors))
+        num_half = int(np.ceil((total_detector_size / 2 - detector_size) / detector_size))
+        num_half = max(num_half, 0)
+        detectors = np.arange(-num_half, num_half + 1, dtype=np.float64)
     else:
-        detectors = np.arange(detector_size / 2, total_detector_size / 2, detector_size)
-        detectors = np.concatenate((np.flip(-detectors), detectors))
+        num_half = int(np.ceil((total_detector_size / 2 - detector_size / 2) / detector_size))
+        num_half = max(num_half, 0)
+        detectors = np.arange(-num_half, num_half, dtype=np.float64)
+        detectors += 0.5
+    detectors *= detector_size
 
     # Calculate the angle from the source to detector positions on the plane detector
-    angles = np.arctan2(detectors, DSD)
+    # (in place, as the positions are not needed afterwards)
+    angles = np.arctan2(detectors, DSD, out=detectors)
 
     # Normailse to give this angle relative to the projection detector
-    normalized_angles = angles / pixel_arclength + orig_num_detectors / 2
+    normalized_angles = angles
+    normalized_angles *= 1 / pixel_arclength
+    normalized_angles += orig_num_detectors / 2
+
+    idx, frac = _interpolation_weights(normalized_angles, orig_num_detectors)
+
+    # The cached arrays are shared between calls
+    idx.setflags(write=False)
+    frac.setflags(write=False)
+
+    return idx, frac
+
+
+def flatten_detector(
+    proj: np.ndarray,
+    DSD: float,
+    arclength: float,
+    oversample: int = 1,
+    backend: str = "auto",
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Flatten the projections.
+
+    The projections are interpolated without being copied if they are a
+    C-contiguous array of float32 (or of uint16, i.e. raw detector counts, with
+    the "c" backend), so these types should be preferred when preparing them
+    upstream.
+
+    The "numba" and "c" backends release the GIL while interpolating, so
+    several scans can be flattened concurrently from a thread pool.
+
+    Args:
+        proj (np.ndarray[ndim=3]): The set of 2D curved projections.
+        DSD (float): The distance from detector to source (in mm).
+        arclength (float): The angular span of the detector (in rad).
+        oversample (int, optional): The amount of oversampling on the flat plane.
+            Defaults to 1.
+        backend (str, optional): The implementation of the interpolation, one of
+            "c", "numba", "numpy" or "auto" (the first one available in this order),
+            or "cuda" to run it on the GPU through CuPy. Defaults to "auto".
+        out (np.ndarray[ndim=3], optional): A C-contiguous float32 array in which to
+            store the result, e.g. to reuse the same buffer across calls on
+            projections of identical shape. It must not overlap `proj`.
+            Defaults to None.
+
+    Returns:
+        np.ndarray[ndim=3]: The set of flattened projections (`out`, if given). With
+            the "cuda" backend, it is a CuPy array left on the GPU.
+    """
+    # Neighbours and weights are the same for every projection and row
+    # (plain floats as cache keys, so that e.g. 0-d arrays are accepted too)
+    idx, frac = _flat_geometry(float(DSD), float(arclength), float(oversample), proj.shape[-1])
 
     # Interpolate
-    flattened_proj = _interpolate(proj, normalized_angles)
+    flattened_proj = _interpolate(proj, idx, frac, backend, out)
 
     return flattened_proj
 
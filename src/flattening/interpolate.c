@@ -1,12 +1,166 @@
-#include <math.h>
+#include <stdint.h>
 #include <stdlib.h>
 #include <omp.h>
 
+// On x86, AVX2 variants of the row functions are compiled alongside the
+// generic ones, and selected at runtime on CPUs that support them
+#if (defined(__x86_64__) || defined(__i386__)) && defined(__GNUC__)
+#define HAVE_AVX2_VARIANTS 1
+#include <immintrin.h>
+#endif
+
+// Maximum number of (projection, row) pairs processed together by a thread
+#define BLOCK_ROWS 16
+// Number of columns whose indices and weights are kept in L1 across a block
+#define BLOCK_COLS 1024
+
+/**
+ * Computes the number of rows processed together by a thread.
+ *
+ * @param total_rows The total number of (projection, row) pairs.
+ * @return The number of rows in a block.
+ */
+static long rows_per_block(long total_rows)
+{
+    // Smaller blocks for small stacks, so that no thread is left without work
+    const int num_threads = omp_get_max_threads();
+    long block_rows = (total_rows + num_threads - 1) / num_threads;
+    if (block_rows > BLOCK_ROWS)
+        block_rows = BLOCK_ROWS;
+    if (block_rows < 1)
+        block_rows = 1;
+    return block_rows;
+}
+
+/**
+ * Interpolates the columns [j_start, j_end) of a single detector row.
+ *
+ * @param in_row The pointer to the row of the curved projection.
+ * @param idx The pointer to the array of left neighbour indices.
+ * @param frac The pointer to the array of interpolation weights.
+ * @param out_row The pointer to the row of the flat projection.
+ * @param j_start The first column to interpolate.
+ * @param j_end The column after the last one to interpolate.
+ */
+static inline void interpolate_row(
+    const float *restrict in_row,
+    const int32_t *restrict idx,
+    const float *restrict frac,
+    float *restrict out_row,
+    int j_start,
+    int j_end)
+{
+#pragma omp simd
+    for (int j = j_start; j < j_end; j++)
+    {
+        float v0 = in_row[idx[j]];             // value at left neighbor
+        float v1 = in_row[idx[j] + 1];         // value at right neighbor
+        out_row[j] = v0 + (v1 - v0) * frac[j]; // linear interpolation
+    }
+}
+
+#ifdef HAVE_AVX2_VARIANTS
+/**
+ * Same as interpolate_row, using AVX2 gathers and FMA.
+ */
+__attribute__((target("avx2,fma"))) static void interpolate_row_avx2(
+    const float *restrict in_row,
+    const int32_t *restrict idx,
+    const float *restrict frac,
+    float *restrict out_row,
+    int j_start,
+    int j_end)
+{
+    int j = j_start;
+
+    // 8 columns at a time: gather both neighbours, then a single FMA
+    const __m256i one = _mm256_set1_epi32(1);
+    for (; j + 8 <= j_end; j += 8)
+    {
+        __m256i iv = _mm256_loadu_si256((const __m256i *)(idx + j));
+        __m256 v0 = _mm256_i32gather_ps(in_row, iv, 4);                        // values at left neighbors
+        __m256 v1 = _mm256_i32gather_ps(in_row, _mm256_add_epi32(iv, one), 4); // values at right neighbors
+        __m256 t = _mm256_loadu_ps(frac + j);
+        _mm256_storeu_ps(out_row + j, _mm256_fmadd_ps(_mm256_sub_ps(v1, v0), t, v0));
+    }
+
+    // remaining columns
+    interpolate_row(in_row, idx, frac, out_row, j, j_end);
+}
+#endif
+
+/**
+ * Same as interpolate_row, for 16-bit unsigned projections.
+ */
+static inline void interpolate_row_u16(
+    const uint16_t *restrict in_row,
+    const int32_t *restrict idx,
+    const float *restrict frac,
+    float *restrict out_row,
+    int j_start,
+    int j_end)
+{
+#pragma omp simd
+    for (int j = j_start; j < j_end; j++)
+    {
+        float v0 = (float)in_row[idx[j]];      // value at left neighbor
+        float v1 = (float)in_row[idx[j] + 1];  // value at right neighbor
+        out_row[j] = v0 + (v1 - v0) * frac[j]; // linear interpolation
+    }
+}
+
+#ifdef HAVE_AVX2_VARIANTS
+/**
+ * Same as interpolate_row_u16, using AVX2 gathers and FMA.
+ */
+__attribute__((target("avx2,fma"))) static void interpolate_row_u16_avx2(
+    const uint16_t *restrict in_row,
+    const int32_t *restrict idx,
+    const float *restrict frac,
+    float *restrict out_row,
+    int j_start,
+    int j_end)
+{
+    int j = j_start;
+
+    // A 32-bit gather at in_row + idx loads both neighbours at once
+    const __m256i low = _mm256_set1_epi32(0xFFFF);
+    for (; j + 8 <= j_end; j += 8)
+    {
+        __m256i iv = _mm256_loadu_si256((const __m256i *)(idx + j));
+        __m256i pair = _mm256_i32gather_epi32((const int *)in_row, iv, 2);
+        __m256 v0 = _mm256_cvtepi32_ps(_mm256_and_si256(pair, low)); // values at left neighbors
+        __m256 v1 = _mm256_cvtepi32_ps(_mm256_srli_epi32(pair, 16)); // values at right neighbors
+        __m256 t = _mm256_loadu_ps(frac + j);
+        _mm256_storeu_ps(out_row + j, _mm256_fmadd_ps(_mm256_sub_ps(v1, v0), t, v0));
+    }
+
+    // remaining columns
+    interpolate_row_u16(in_row, idx, frac, out_row, j, j_end);
+}
+#endif
+
+/**
+ * Checks whether the AVX2 variants of the row functions can be used.
+ *
+ * @return 1 if the CPU supports AVX2 and FMA, 0 otherwise.
+ */
+static int use_avx2(void)
+{
+#ifdef HAVE_AVX2_VARIANTS
+    __builtin_cpu_init();
+    return __builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma");
+#else
+    return 0;
+#endif
+}
+
 /**
  * Efficiently performs the interpolation loop. (See Python functions.)
  *
  * @param proj The pointer to the array of curved projections.
- * @param normalized_angles The pointer to the array of angles.
+ * @param idx The pointer to the array of left neighbour indices.
+ * @param frac The pointer to the array of interpolation weights.
  * @param out The pointer to the array of flat projections.
  * @param num_proj The number of projections.
  * @param num_rows The number of detector rows.
@@ -14,43 +168,103 @@
  * @param num_cols The number of (flat) detector columns(> curved).
  */
 void interpolation_loop(
-    const float *proj,               // input [num_proj, num_rows, orig_num_detectors]
-    const double *normalized_angles, // input [num_cols]
-    float *out,                      // output [num_proj, num_rows, num_cols]
+    const float *restrict proj,  // input [num_proj, num_rows, orig_num_detectors]
+    const int32_t *restrict idx, // input [num_cols]
+    const float *restrict frac,  // input [num_cols]
+    float *restrict out,         // output [num_proj, num_rows, num_cols]
     int num_proj,
     int num_rows,
     int orig_num_detectors,
     int num_cols)
 {
-// Parallelize outer loops over i and r
-#pragma omp parallel for collapse(2) schedule(static)
-    for (int i = 0; i < num_proj; i++)
+    // (i,r) rows are contiguous in both in & out, so they are tiled as one axis
+    const long total_rows = (long)num_proj * num_rows;
+    const long block_rows = rows_per_block(total_rows);
+    const long num_blocks = (total_rows + block_rows - 1) / block_rows;
+
+    // Row function for this CPU
+    void (*row)(const float *, const int32_t *, const float *, float *, int, int) = interpolate_row;
+#ifdef HAVE_AVX2_VARIANTS
+    if (use_avx2())
+        row = interpolate_row_avx2;
+#endif
+
+// Parallelize over blocks of rows
+#pragma omp parallel for schedule(static)
+    for (long b = 0; b < num_blocks; b++)
     {
-        for (int r = 0; r < num_rows; r++)
+        const long n_start = b * block_rows;
+        const long n_end = n_start + block_rows < total_rows ? n_start + block_rows : total_rows;
+
+        for (int j_start = 0; j_start < num_cols; j_start += BLOCK_COLS)
         {
-            for (int j = 0; j < num_cols; j++)
+            const int j_end = j_start + BLOCK_COLS < num_cols ? j_start + BLOCK_COLS : num_cols;
+
+            for (long n = n_start; n < n_end; n++)
             {
-                double x = normalized_angles[j]; // pos on curved detector
-                int idx = (int)floor(x);         // index of left neighbor
-                double t = x - idx;              // distance from right neighbor
-
-                // index of start of (i,r) row in in & out
-                int proj_offset = (i * num_rows + r) * orig_num_detectors;
-                int out_offset = (i * num_rows + r) * num_cols;
-
-                // before first detector
-                if (idx < 0)
-                    out[out_offset + j] = proj[proj_offset];
-                // after last detector
-                else if (idx >= orig_num_detectors - 1)
-                    out[out_offset + j] = proj[proj_offset + orig_num_detectors - 1];
-                else
-                {
-                    float v0 = proj[proj_offset + idx];                     // value at left neighbor
-                    float v1 = proj[proj_offset + idx + 1];                 // value at right neighbor
-                    out[out_offset + j] = (float)((1.0 - t) * v0 + t * v1); // linear interpolation
-                }
+                // (i,r) row n of in & out
+                row(proj + n * orig_num_detectors, idx, frac, out + n * num_cols, j_start, j_end);
             }
         }
     }
 }
+
+/**
+ * Same as interpolation_loop, for 16-bit unsigned projections, so that raw
+ * detector counts need not be converted to float32 beforehand.
+ */
+void interpolation_loop_u16(
+    const uint16_t *restrict proj, // input [num_proj, num_rows, orig_num_detectors]
+    const int32_t *restrict idx,   // input [num_cols]
+    const float *restrict frac,    // input [num_cols]
+    float *restrict out,           // output [num_proj, num_rows, num_cols]
+    int num_proj,
+    int num_rows,
+    int orig_num_detectors,
+    int num_cols)
+{
+    const long total_rows = (long)num_proj * num_rows;
+    const long block_rows = rows_per_block(total_rows);
+    const long num_blocks = (total_rows + block_rows - 1) / block_rows;
+
+    void (*row)(const uint16_t *, const int32_t *, const float *, float *, int, int) = interpolate_row_u16;
+#ifdef HAVE_AVX2_VARIANTS
+    if (use_avx2())
+        row = interpolate_row_u16_avx2;
+#endif
+
+#pragma omp parallel for schedule(static)
+    for (long b = 0; b < num_blocks; b++)
+    {
+        const long n_start = b * block_rows;
+        const long n_end = n_start + block_rows < total_rows ? n_start + block_rows : total_rows;
+
+        for (int j_start = 0; j_start < num_cols; j_start += BLOCK_COLS)
+        {
+            const int j_end = j_start + BLOCK_COLS < num_cols ? j_start + BLOCK_COLS : num_cols;
+
+            for (long n = n_start; n < n_end; n++)
+            {
+                row(proj + n * orig_num_detectors, idx, frac, out + n * num_cols, j_start, j_end);
+            }
+        }
+    }
+}
+
+/**
+ * Starts the OpenMP thread pool, so that it is already running when the
+ * interpolation loop is called.
+ *
+ * @param num_threads The number of threads to use (<= 0 keeps the default).
+ */
+void warmup(int num_threads)
+{
+    omp_set_dynamic(0);
+    if (num_threads > 0)
+        omp_set_num_threads(num_threads);
+
+// Empty parallel region, which only creates the team of threads
+#pragma omp parallel
+    {
+    }
+}